@@ -0,0 +1,173 @@
+"""
+Armazenamento e entrega de anexos endereçados por conteúdo
+O hash SHA-256 é calculado em streaming (por chunks) e define o caminho do arquivo,
+de modo que envios repetidos do mesmo arquivo não ocupam espaço extra em disco
+"""
+import hashlib
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.core.files.storage import default_storage
+from django.db import IntegrityError, transaction
+from django.http import FileResponse, HttpResponse, HttpResponseNotModified, StreamingHttpResponse
+
+from .models import Anexo
+
+HASH_REGEX = r'[0-9a-f]{64}'
+TAMANHO_BLOCO = 64 * 1024
+
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+
+def calcular_hash(arquivo):
+    """Calcula o SHA-256 do arquivo sem carregá-lo inteiro em memória"""
+    sha256 = hashlib.sha256()
+    for chunk in arquivo.chunks(TAMANHO_BLOCO):
+        sha256.update(chunk)
+    arquivo.seek(0)
+    return sha256.hexdigest()
+
+
+def caminho_anexo(hash_conteudo, nome_original=''):
+    """Caminho determinístico: anexos/ab/cd/<hash><extensão>"""
+    extensao = os.path.splitext(nome_original)[1].lower()[:10]
+    return f'anexos/{hash_conteudo[:2]}/{hash_conteudo[2:4]}/{hash_conteudo}{extensao}'
+
+
+def armazenar_anexo(arquivo):
+    """
+    Retorna o Anexo correspondente ao conteúdo enviado, gravando em disco apenas
+    se ainda não existir (a contagem de referências é feita pela Requisicao)
+    Deve ser chamada dentro da transação que cria a referência
+    """
+    hash_conteudo = calcular_hash(arquivo)
+    # Bloqueia o registro até o commit: decrementar concorrente espera a nova referência
+    existente = Anexo.objects.select_for_update().filter(hash=hash_conteudo).first()
+    if existente is not None:
+        existente._conteudo_enviado = arquivo  # Permite restaurar o arquivo (Anexo.restaurar)
+        return existente
+
+    nome = caminho_anexo(hash_conteudo, arquivo.name or '')
+    # Arquivo pode já estar em disco (ex.: transação anterior desfeita)
+    if not default_storage.exists(nome):
+        nome = default_storage.save(nome, arquivo)
+
+    content_type = getattr(arquivo, 'content_type', None) or mimetypes.guess_type(nome)[0] or ''
+    try:
+        with transaction.atomic():
+            anexo = Anexo.objects.create(
+                hash=hash_conteudo,
+                arquivo=nome,
+                nome_original=os.path.basename(arquivo.name or '')[:255],
+                content_type=content_type[:100],
+                tamanho=arquivo.size,
+            )
+    except IntegrityError:
+        # Upload concorrente do mesmo conteúdo
+        anexo = Anexo.objects.select_for_update().get(hash=hash_conteudo)
+    anexo._conteudo_enviado = arquivo
+    return anexo
+
+
+def nome_variante(nome_original, variante):
+    """Nome de download da variante: foto.png -> foto.jpg / foto_thumbnail.jpg"""
+    if not nome_original:
+        return None
+    base = os.path.splitext(nome_original)[0]
+    return f'{base}.jpg' if variante == 'web' else f'{base}_{variante}.jpg'
+
+
+def _intervalo_solicitado(cabecalho, tamanho):
+    """
+    Interpreta o cabeçalho Range (apenas um intervalo, RFC 7233)
+    Retorna (inicio, fim) inclusivo, None se ausente/ignorado ou False se insatisfazível
+    """
+    if not cabecalho:
+        return None
+    match = _RANGE_RE.match(cabecalho.strip())
+    if not match:
+        return None  # Múltiplos intervalos ou unidade desconhecida: entrega completa
+    inicio, fim = match.groups()
+    if not inicio and not fim:
+        return None
+    if not inicio:
+        # Sufixo: últimos N bytes
+        sufixo = int(fim)
+        if sufixo == 0:
+            return False
+        return max(tamanho - sufixo, 0), tamanho - 1
+    inicio = int(inicio)
+    fim = min(int(fim), tamanho - 1) if fim else tamanho - 1
+    if inicio >= tamanho or inicio > fim:
+        return False
+    return inicio, fim
+
+
+def _ler_intervalo(arquivo, inicio, quantidade):
+    try:
+        arquivo.seek(inicio)
+        while quantidade > 0:
+            chunk = arquivo.read(min(TAMANHO_BLOCO, quantidade))
+            if not chunk:
+                break
+            quantidade -= len(chunk)
+            yield chunk
+    finally:
+        arquivo.close()
+
+
+def servir_anexo(request, anexo, variante=None):
+    """
+    Entrega o arquivo (ou uma variante: web/thumbnail/preview) com suporte a
+    requisições condicionais (ETag) e parciais (Range)
+    Se ANEXOS_SENDFILE_HEADER estiver configurado (ex.: X-Accel-Redirect no nginx),
+    a entrega é delegada ao servidor web
+    """
+    if variante:
+        arquivo = getattr(anexo, variante)
+        etag = f'"{anexo.hash}-{variante}"'
+        content_type = mimetypes.guess_type(arquivo.name)[0] or 'application/octet-stream'
+        tamanho = arquivo.size
+        nome = nome_variante(anexo.nome_original, variante)
+    else:
+        arquivo = anexo.arquivo
+        etag = f'"{anexo.hash}"'
+        content_type = anexo.content_type or 'application/octet-stream'
+        tamanho = anexo.tamanho
+        nome = anexo.nome_original or None
+
+    if request.headers.get('If-None-Match') == etag:
+        return HttpResponseNotModified(headers={'ETag': etag})
+
+    cabecalho_sendfile = getattr(settings, 'ANEXOS_SENDFILE_HEADER', '')
+    if cabecalho_sendfile:
+        response = HttpResponse(content_type=content_type)
+        response[cabecalho_sendfile] = settings.ANEXOS_SENDFILE_PREFIX + arquivo.name
+    else:
+        intervalo = _intervalo_solicitado(request.headers.get('Range'), tamanho)
+        if request.headers.get('If-Range') not in (None, etag):
+            intervalo = None
+
+        if intervalo is False:
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{tamanho}'
+        elif intervalo is None:
+            response = FileResponse(arquivo.open('rb'), content_type=content_type, filename=nome)
+        else:
+            inicio, fim = intervalo
+            quantidade = fim - inicio + 1
+            response = StreamingHttpResponse(
+                _ler_intervalo(arquivo.storage.open(arquivo.name, 'rb'), inicio, quantidade),
+                status=206,
+                content_type=content_type,
+            )
+            response['Content-Range'] = f'bytes {inicio}-{fim}/{tamanho}'
+            response['Content-Length'] = str(quantidade)
+
+    response['Accept-Ranges'] = 'bytes'
+    response['ETag'] = etag
+    # Conteúdo imutável: o mesmo hash nunca muda de conteúdo
+    response['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
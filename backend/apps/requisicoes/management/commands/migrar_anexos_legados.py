@@ -0,0 +1,54 @@
+"""
+Converte anexos legados (FileField `anexo`, em anexos/%Y/%m/%d/) em Anexos
+deduplicados por conteúdo e aponta as requisições para eles
+Uso: python manage.py migrar_anexos_legados [--remover-originais]
+"""
+import os
+
+from django.core.files import File
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from apps.requisicoes.anexos import armazenar_anexo
+from apps.requisicoes.models import Requisicao
+from apps.requisicoes.tasks import agendar_processamento_anexo
+
+
+class Command(BaseCommand):
+    help = 'Migra anexos legados (caminho por data) para o armazenamento por conteúdo'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--remover-originais',
+            action='store_true',
+            help='Apaga o arquivo legado após a migração (o conteúdo fica no caminho por hash)',
+        )
+
+    def handle(self, *args, **options):
+        pendentes = (
+            Requisicao.objects.filter(anexo_armazenado__isnull=True)
+            .exclude(anexo__isnull=True).exclude(anexo='')
+        )
+        migradas, ausentes = 0, 0
+        for requisicao in pendentes.iterator():
+            legado = requisicao.anexo
+            if not legado.storage.exists(legado.name):
+                ausentes += 1
+                self.stderr.write(f'Req #{requisicao.pk}: arquivo {legado.name} não encontrado')
+                continue
+
+            with legado.storage.open(legado.name, 'rb') as arquivo, transaction.atomic():
+                anexo = armazenar_anexo(File(arquivo, name=os.path.basename(legado.name)))
+                requisicao.anexo_armazenado = anexo
+                requisicao.anexo = None
+                requisicao.save()
+                if anexo.processado_em is None:
+                    transaction.on_commit(lambda anexo_id=anexo.pk: agendar_processamento_anexo(anexo_id))
+
+            if options['remover_originais']:
+                legado.storage.delete(legado.name)
+            migradas += 1
+
+        self.stdout.write(self.style.SUCCESS(
+            f'{migradas} anexos migrados' + (f', {ausentes} arquivos não encontrados' if ausentes else '')
+        ))
@@ -0,0 +1,22 @@
+"""
+Reconstrói o índice de similaridade (BucketSimilaridade) das requisições abertas
+Uso: python manage.py reindexar_similaridade
+"""
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from apps.requisicoes.models import BucketSimilaridade, Requisicao
+
+
+class Command(BaseCommand):
+    help = 'Reconstrói o índice MinHash/LSH usado na detecção de requisições similares'
+
+    def handle(self, *args, **options):
+        with transaction.atomic():
+            BucketSimilaridade.objects.all().delete()
+            abertas = Requisicao.objects.filter(status__in=Requisicao.STATUS_ABERTOS)
+            total = 0
+            for requisicao in abertas.iterator():
+                BucketSimilaridade.indexar(requisicao)
+                total += 1
+        self.stdout.write(self.style.SUCCESS(f'{total} requisições abertas indexadas'))
@@ -0,0 +1,35 @@
+"""
+Reagenda o processamento de anexos que continuam pendentes
+(tarefa perdida por broker indisponível, worker reiniciado ou tentativas esgotadas)
+Uso: python manage.py reprocessar_anexos [--minutos 10]
+Pode ser executado periodicamente (cron)
+"""
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from apps.requisicoes.tasks import (
+    PROCESSAMENTO_ATRASADO_APOS,
+    agendar_processamento_anexo,
+    anexos_pendentes_atrasados,
+)
+
+
+class Command(BaseCommand):
+    help = 'Reenfileira o processamento de anexos ainda não processados'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--minutos',
+            type=int,
+            default=int(PROCESSAMENTO_ATRASADO_APOS.total_seconds() // 60),
+            help='Considera apenas anexos pendentes há mais de N minutos',
+        )
+
+    def handle(self, *args, **options):
+        pendentes = anexos_pendentes_atrasados(timedelta(minutes=options['minutos']))
+        total = 0
+        for anexo_id in pendentes.values_list('id', flat=True).iterator():
+            agendar_processamento_anexo(anexo_id)
+            total += 1
+        self.stdout.write(self.style.SUCCESS(f'{total} anexos reenfileirados para processamento'))
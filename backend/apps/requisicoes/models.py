@@ -2,10 +2,119 @@
 Models para requisições de manutenção
 Implementa validações e relacionamentos seguindo princípios SOLID
 """
-from django.db import models
+import mimetypes
+
+from django.conf import settings
+from django.db import models, transaction
+from django.db.models import Count, F
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
 from django.contrib.auth.models import User
 from django.core.exceptions import ValidationError
 
+from .similaridade import calcular_buckets, jaccard, normalizar_localizacao, trigramas
+
+
+class Anexo(models.Model):
+    """
+    Arquivo anexado armazenado por conteúdo (content-addressed)
+    O mesmo arquivo enviado em várias requisições é gravado uma única vez;
+    `referencias` conta quantas requisições apontam para ele
+    """
+    hash = models.CharField(max_length=64, unique=True, help_text='SHA-256 do conteúdo do arquivo')
+    arquivo = models.FileField(max_length=255)
+    nome_original = models.CharField(max_length=255, blank=True)
+    content_type = models.CharField(max_length=100, blank=True)
+    tamanho = models.BigIntegerField(help_text='Tamanho do arquivo em bytes')
+    referencias = models.PositiveIntegerField(default=0)
+    criado_em = models.DateTimeField(auto_now_add=True)
+    
+    # Derivados gerados em background para imagens (ver tasks.processar_anexo)
+    largura = models.PositiveIntegerField(null=True, blank=True)
+    altura = models.PositiveIntegerField(null=True, blank=True)
+    web = models.FileField(max_length=255, blank=True, help_text='Imagem sem EXIF, servida no lugar do original')
+    thumbnail = models.FileField(max_length=255, blank=True)
+    preview = models.FileField(max_length=255, blank=True)
+    processado_em = models.DateTimeField(null=True, blank=True)
+    
+    VARIANTES = ('web', 'thumbnail', 'preview')
+    
+    class Meta:
+        verbose_name = 'Anexo'
+        verbose_name_plural = 'Anexos'
+    
+    def __str__(self):
+        return f"{self.nome_original or self.hash[:12]} ({self.referencias} ref.)"
+    
+    @property
+    def imagem_pendente(self):
+        """Imagem ainda sem a variante web (o original pode conter EXIF/GPS)"""
+        eh_imagem = (self.content_type or mimetypes.guess_type(self.arquivo.name)[0] or '').startswith('image/')
+        return eh_imagem and self.processado_em is None
+    
+    @classmethod
+    def visiveis_para(cls, user):
+        """
+        Anexos acessíveis ao usuário (mesma regra de Requisicao.visiveis_para):
+        solicitantes só veem anexos das próprias requisições
+        """
+        if not hasattr(user, 'perfil'):
+            return cls.objects.none()
+        if user.perfil.role == 'solicitante':
+            return cls.objects.filter(requisicoes__solicitante=user).distinct()
+        return cls.objects.all()
+    
+    @classmethod
+    def incrementar(cls, anexo_id, anexo=None):
+        """Soma uma referência; se o registro foi excluído concorrentemente, restaura-o"""
+        if cls.objects.filter(pk=anexo_id).update(referencias=F('referencias') + 1):
+            return
+        if anexo is None:
+            raise cls.DoesNotExist(f'Anexo {anexo_id} foi excluído')
+        anexo.restaurar()
+    
+    def restaurar(self):
+        """
+        Recria (mesmo pk) um Anexo excluído por decrementar concorrente, regravando o
+        arquivo a partir do upload em memória se ele já tiver sido removido do disco
+        """
+        storage = self.arquivo.storage
+        if not storage.exists(self.arquivo.name):
+            conteudo = getattr(self, '_conteudo_enviado', None)
+            if conteudo is None:
+                raise Anexo.DoesNotExist(f'Arquivo do anexo {self.hash} foi removido')
+            conteudo.seek(0)
+            self.arquivo.name = storage.save(self.arquivo.name, conteudo)
+        # Derivados foram removidos junto com o registro: serão gerados novamente
+        self.web = self.thumbnail = self.preview = ''
+        self.largura = self.altura = self.processado_em = None
+        self.referencias = 1
+        self.save(force_insert=True)
+    
+    @classmethod
+    def decrementar(cls, anexo_id):
+        """Remove a referência; apaga registro e arquivo quando não há mais nenhuma"""
+        with transaction.atomic():
+            anexo = cls.objects.select_for_update().filter(pk=anexo_id).first()
+            if anexo is None:
+                return
+            if anexo.referencias > 1:
+                cls.objects.filter(pk=anexo_id).update(referencias=F('referencias') - 1)
+                return
+            storage = anexo.arquivo.storage
+            nomes = [campo.name for campo in (anexo.arquivo, anexo.web, anexo.thumbnail, anexo.preview) if campo]
+            hash_conteudo = anexo.hash
+            anexo.delete()
+            
+            def remover_arquivos():
+                # Não apaga se o mesmo conteúdo foi restaurado/reenviado nesse meio tempo
+                if not cls.objects.filter(hash=hash_conteudo).exists():
+                    for nome in nomes:
+                        storage.delete(nome)
+            
+            transaction.on_commit(remover_arquivos)
+
+
 class Requisicao(models.Model):
     """
     Model principal para requisições de manutenção
@@ -23,6 +132,10 @@ class Requisicao(models.Model):
         ('concluido', 'Concluído'),
         ('cancelado', 'Cancelado'),
     ]
+    STATUS_ABERTOS = ('pendente', 'em_andamento')
+    
+    # Campos que alteram o índice de similaridade (ver BucketSimilaridade)
+    CAMPOS_SIMILARIDADE = ('titulo', 'descricao', 'localizacao', 'status')
     
     # Relacionamentos
     solicitante = models.ForeignKey(
@@ -58,9 +171,19 @@ class Requisicao(models.Model):
     localizacao = models.CharField(max_length=200, blank=True, help_text='Local onde a manutenção deve ser realizada')
     observacoes = models.TextField(blank=True, help_text='Observações adicionais')
     
-    # Anexos (campo para armazenar caminho de arquivos)
+    # Legado: caminho dos uploads anteriores à deduplicação, mantido na mesma coluna
+    # até ser convertido por `manage.py migrar_anexos_legados`
     anexo = models.FileField(upload_to='anexos/%Y/%m/%d/', blank=True, null=True)
     
+    # Anexo deduplicado por conteúdo (ver Anexo); exposto na API como `anexo`
+    anexo_armazenado = models.ForeignKey(
+        Anexo,
+        on_delete=models.PROTECT,
+        null=True,
+        blank=True,
+        related_name='requisicoes',
+    )
+    
     # Timestamps para análise de dados
     criado_em = models.DateTimeField(auto_now_add=True)
     atualizado_em = models.DateTimeField(auto_now=True)
@@ -76,17 +199,70 @@ class Requisicao(models.Model):
             models.Index(fields=['status', 'prioridade']),
         ]
     
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # __dict__ evita consulta extra quando o campo foi adiado (.only/.defer)
+        self._anexo_id_original = self.__dict__.get('anexo_armazenado_id', models.DEFERRED)
+        self._similaridade_original = self._valores_similaridade()
+    
     def __str__(self):
         return f"Req #{self.id} - {self.titulo} ({self.get_prioridade_display()})"
     
+    @classmethod
+    def visiveis_para(cls, user):
+        """
+        Requisições acessíveis ao usuário:
+        - Solicitante: apenas as próprias requisições
+        - Aprovador/Executor: todas
+        """
+        if not hasattr(user, 'perfil'):
+            return cls.objects.none()
+        if user.perfil.role == 'solicitante':
+            return cls.objects.filter(solicitante=user)
+        return cls.objects.all()
+    
     def clean(self):
         """Validação customizada (OWASP - Input Validation)"""
         if not self.descricao or len(self.descricao.strip()) < 10:
             raise ValidationError('Descrição deve ter pelo menos 10 caracteres')
     
     def save(self, *args, **kwargs):
-        self.full_clean()  # Executa validações antes de salvar
-        super().save(*args, **kwargs)
+        # Executa validações antes de salvar; o anexo é conferido por Anexo.incrementar
+        # (que o restaura se tiver sido excluído concorrentemente)
+        self.full_clean(exclude=['anexo_armazenado'])
+        with transaction.atomic():
+            nova = self._state.adding
+            if nova:
+                # Registro novo: o anexo recebido no construtor ainda não foi contado
+                self._anexo_id_original = None
+            elif self._anexo_id_original is models.DEFERRED:
+                self._anexo_id_original = (
+                    Requisicao.objects.filter(pk=self.pk).values_list('anexo_armazenado_id', flat=True).first()
+                )
+            super().save(*args, **kwargs)
+            self._atualizar_referencias_anexo()
+            self._atualizar_indice_similaridade(nova)
+    
+    def _atualizar_referencias_anexo(self):
+        """Mantém a contagem de referências do Anexo quando ele é trocado"""
+        if self.anexo_armazenado_id == self._anexo_id_original:
+            return
+        if self.anexo_armazenado_id:
+            Anexo.incrementar(self.anexo_armazenado_id, self._meta.get_field('anexo_armazenado').get_cached_value(self, None))
+        if self._anexo_id_original:
+            Anexo.decrementar(self._anexo_id_original)
+        self._anexo_id_original = self.anexo_armazenado_id
+    
+    def _valores_similaridade(self):
+        return tuple(self.__dict__.get(campo, models.DEFERRED) for campo in self.CAMPOS_SIMILARIDADE)
+    
+    def _atualizar_indice_similaridade(self, nova=False):
+        """Indexa registros novos; nos existentes, só quando texto, local ou status mudaram"""
+        valores = self._valores_similaridade()
+        if not nova and valores == self._similaridade_original:
+            return
+        BucketSimilaridade.indexar(self)
+        self._similaridade_original = valores
 
 
 class HistoricoRequisicao(models.Model):
@@ -107,4 +283,87 @@ class HistoricoRequisicao(models.Model):
         verbose_name_plural = 'Históricos'
     
     def __str__(self):
-        return f"Req #{self.requisicao.id}: {self.status_anterior} → {self.status_novo}"
\ No newline at end of file
+        return f"Req #{self.requisicao.id}: {self.status_anterior} → {self.status_novo}"
+
+
+class BucketSimilaridade(models.Model):
+    """
+    Índice MinHash/LSH de requisições abertas, por localização
+    Cada requisição aberta gera um bucket por banda da assinatura; a busca por
+    similares é uma consulta indexada por (localizacao, bucket), sem varrer o backlog
+    """
+    MAX_CANDIDATOS = 50
+    
+    requisicao = models.ForeignKey(Requisicao, on_delete=models.CASCADE, related_name='buckets_similaridade')
+    localizacao = models.CharField(max_length=200, help_text='Localização normalizada')
+    bucket = models.BigIntegerField()
+    
+    class Meta:
+        verbose_name = 'Bucket de Similaridade'
+        verbose_name_plural = 'Buckets de Similaridade'
+        indexes = [
+            models.Index(fields=['localizacao', 'bucket']),
+        ]
+    
+    def __str__(self):
+        return f"Req #{self.requisicao_id} @ {self.localizacao}: {self.bucket}"
+    
+    @classmethod
+    def indexar(cls, requisicao):
+        """Substitui os buckets da requisição; fechadas ou sem localização saem do índice"""
+        cls.objects.filter(requisicao_id=requisicao.pk).delete()
+        localizacao = normalizar_localizacao(requisicao.localizacao)
+        if requisicao.status not in Requisicao.STATUS_ABERTOS or not localizacao:
+            return
+        buckets = calcular_buckets(trigramas(f'{requisicao.titulo} {requisicao.descricao}'))
+        cls.objects.bulk_create([
+            cls(requisicao_id=requisicao.pk, localizacao=localizacao, bucket=bucket)
+            for bucket in set(buckets)
+        ])
+    
+    @classmethod
+    def buscar_similares(cls, titulo, descricao, localizacao, excluir_id=None, limite=5, usuario=None):
+        """
+        Requisições abertas no mesmo local com texto similar, ordenadas por similaridade
+        Cada resultado recebe o atributo `similaridade` (Jaccard dos trigramas)
+        Com `usuario`, considera apenas as requisições visíveis a ele (Requisicao.visiveis_para)
+        """
+        limiar = getattr(settings, 'SIMILARIDADE_LIMIAR', 0.35)
+        localizacao = normalizar_localizacao(localizacao)
+        conjunto = trigramas(f'{titulo} {descricao}')
+        buckets = calcular_buckets(conjunto)
+        if not localizacao or not buckets:
+            return []
+        
+        candidatos_ids = cls.objects.filter(localizacao=localizacao, bucket__in=buckets)
+        if excluir_id is not None:
+            candidatos_ids = candidatos_ids.exclude(requisicao_id=excluir_id)
+        if usuario is not None:
+            # Filtra antes do corte para não desperdiçar candidatos com requisições invisíveis
+            candidatos_ids = candidatos_ids.filter(requisicao__in=Requisicao.visiveis_para(usuario))
+        # Mais bandas em comum = mais provável ser similar; o corte mantém os melhores candidatos
+        candidatos_ids = (
+            candidatos_ids.values('requisicao_id')
+            .annotate(bandas=Count('id'))
+            .order_by('-bandas', '-requisicao_id')
+            .values_list('requisicao_id', flat=True)[:cls.MAX_CANDIDATOS]
+        )
+        
+        candidatos = Requisicao.objects.filter(
+            id__in=list(candidatos_ids), status__in=Requisicao.STATUS_ABERTOS
+        ).only('id', 'titulo', 'descricao', 'localizacao', 'status', 'prioridade', 'criado_em')
+        
+        similares = []
+        for candidato in candidatos:
+            candidato.similaridade = jaccard(conjunto, trigramas(f'{candidato.titulo} {candidato.descricao}'))
+            if candidato.similaridade >= limiar:
+                similares.append(candidato)
+        similares.sort(key=lambda r: r.similaridade, reverse=True)
+        return similares[:limite]
+
+
+@receiver(post_delete, sender=Requisicao)
+def liberar_anexo_requisicao(sender, instance, **kwargs):
+    """Libera a referência ao anexo (cobre também exclusões em cascata)"""
+    if instance.anexo_armazenado_id:
+        Anexo.decrementar(instance.anexo_armazenado_id)
@@ -3,8 +3,11 @@ Serializers para API REST
 Implementa validações e transformações de dados (DRY principle)
 """
 from rest_framework import serializers
+from rest_framework.reverse import reverse
 from django.contrib.auth.models import User
-from .models import Requisicao, HistoricoRequisicao
+from django.db import transaction
+from .anexos import armazenar_anexo
+from .models import Anexo, BucketSimilaridade, Requisicao, HistoricoRequisicao
 from apps.usuarios.models import PerfilUsuario
 
 class UserSerializer(serializers.ModelSerializer):
@@ -27,7 +30,79 @@ class HistoricoSerializer(serializers.ModelSerializer):
         read_only_fields = ['id', 'criado_em']
 
 
-class RequisicaoSerializer(serializers.ModelSerializer):
+class AnexoField(serializers.FileField):
+    """Recebe o upload como arquivo e representa o Anexo pela URL de download"""
+    
+    def to_representation(self, value):
+        if not value:
+            return None
+        return reverse('anexo-download', kwargs={'hash': value.hash}, request=self.context.get('request'))
+
+
+class AnexoSerializer(serializers.ModelSerializer):
+    """Metadados do anexo (também usado para verificar se o conteúdo já existe)"""
+    thumbnail = serializers.SerializerMethodField()
+    preview = serializers.SerializerMethodField()
+    
+    class Meta:
+        model = Anexo
+        fields = [
+            'hash', 'nome_original', 'content_type', 'tamanho', 'largura', 'altura',
+            'thumbnail', 'preview', 'criado_em'
+        ]
+        read_only_fields = fields
+    
+    def _url_variante(self, anexo, variante):
+        """URL da imagem redimensionada (None enquanto o processamento não terminar)"""
+        if not getattr(anexo, variante):
+            return None
+        url = reverse('anexo-download', kwargs={'hash': anexo.hash}, request=self.context.get('request'))
+        return f'{url}?variante={variante}'
+    
+    def get_thumbnail(self, anexo):
+        return self._url_variante(anexo, 'thumbnail')
+    
+    def get_preview(self, anexo):
+        return self._url_variante(anexo, 'preview')
+
+
+class AnexoDeduplicadoMixin:
+    """
+    Converte o upload em Anexo deduplicado por conteúdo
+    Aceita `anexo_hash` no lugar do arquivo quando o conteúdo já está armazenado
+    e visível ao usuário, evitando reenviar o mesmo arquivo
+    """
+    
+    def validate_anexo_hash(self, value):
+        value = value.lower()
+        anexo = Anexo.visiveis_para(self.context['request'].user).filter(hash=value).first()
+        if anexo is None:
+            raise serializers.ValidationError('Nenhum anexo armazenado com este hash; envie o arquivo.')
+        return anexo
+    
+    def _resolver_anexo(self, validated_data):
+        anexo_existente = validated_data.pop('anexo_hash', None)
+        if 'anexo_armazenado' in validated_data:
+            arquivo = validated_data['anexo_armazenado']
+            validated_data['anexo_armazenado'] = armazenar_anexo(arquivo) if arquivo else None
+        elif anexo_existente is not None:
+            # Revalida com bloqueio: pode ter sido excluído após a validação
+            anexo = Anexo.objects.select_for_update().filter(pk=anexo_existente.pk).first()
+            if anexo is None:
+                raise serializers.ValidationError({'anexo_hash': 'Anexo removido; envie o arquivo.'})
+            validated_data['anexo_armazenado'] = anexo
+        return validated_data
+    
+    def create(self, validated_data):
+        with transaction.atomic():
+            return super().create(self._resolver_anexo(validated_data))
+    
+    def update(self, instance, validated_data):
+        with transaction.atomic():
+            return super().update(instance, self._resolver_anexo(validated_data))
+
+
+class RequisicaoSerializer(AnexoDeduplicadoMixin, serializers.ModelSerializer):
     """
     Serializer principal para Requisições
     Inclui validações customizadas e campos read-only para segurança
@@ -36,12 +111,15 @@ class RequisicaoSerializer(serializers.ModelSerializer):
     aprovador_nome = serializers.CharField(source='aprovador.get_full_name', read_only=True, allow_null=True)
     executor_nome = serializers.CharField(source='executor.get_full_name', read_only=True, allow_null=True)
     historico = HistoricoSerializer(many=True, read_only=True)
+    anexo = AnexoField(source='anexo_armazenado', required=False, allow_null=True)
+    anexo_hash = serializers.RegexField(r'^[0-9a-fA-F]{64}$', required=False, write_only=True)
+    anexo_detalhes = AnexoSerializer(source='anexo_armazenado', read_only=True)
     
     class Meta:
         model = Requisicao
         fields = [
             'id', 'titulo', 'descricao', 'prioridade', 'status', 'localizacao', 'observacoes',
-            'anexo', 'solicitante', 'solicitante_nome', 'aprovador', 'aprovador_nome',
+            'anexo', 'anexo_hash', 'anexo_detalhes', 'solicitante', 'solicitante_nome', 'aprovador', 'aprovador_nome',
             'executor', 'executor_nome', 'criado_em', 'atualizado_em', 'data_aprovacao',
             'data_conclusao', 'historico'
         ]
@@ -65,17 +143,42 @@ class RequisicaoSerializer(serializers.ModelSerializer):
         return super().create(validated_data)
 
 
-class RequisicaoCreateSerializer(serializers.ModelSerializer):
-    """Serializer simplificado para criação (apenas campos necessários)"""
+class RequisicaoSimilarSerializer(serializers.ModelSerializer):
+    """Resumo de requisição aberta similar (detecção de duplicatas)"""
+    similaridade = serializers.FloatField(read_only=True)
+    
+    class Meta:
+        model = Requisicao
+        fields = ['id', 'titulo', 'status', 'prioridade', 'localizacao', 'criado_em', 'similaridade']
+        read_only_fields = fields
+
+
+class RequisicaoCreateSerializer(AnexoDeduplicadoMixin, serializers.ModelSerializer):
+    """
+    Serializer simplificado para criação (apenas campos necessários)
+    A resposta inclui `similares`: requisições abertas parecidas no mesmo local,
+    apenas como aviso de possível duplicata (a criação nunca é bloqueada)
+    """
+    anexo = AnexoField(source='anexo_armazenado', required=False, allow_null=True)
+    anexo_hash = serializers.RegexField(r'^[0-9a-fA-F]{64}$', required=False, write_only=True)
+    similares = serializers.SerializerMethodField()
     
     class Meta:
         model = Requisicao
-        fields = ['titulo', 'descricao', 'prioridade', 'localizacao', 'anexo']
+        fields = ['titulo', 'descricao', 'prioridade', 'localizacao', 'anexo', 'anexo_hash', 'similares']
     
     def validate_descricao(self, value):
         if len(value.strip()) < 10:
             raise serializers.ValidationError('Descrição deve ter pelo menos 10 caracteres.')
         return value
+    
+    def get_similares(self, requisicao):
+        """Possíveis duplicatas visíveis ao usuário (ver BucketSimilaridade.buscar_similares)"""
+        similares = BucketSimilaridade.buscar_similares(
+            requisicao.titulo, requisicao.descricao, requisicao.localizacao,
+            excluir_id=requisicao.pk, usuario=self.context['request'].user
+        )
+        return RequisicaoSimilarSerializer(similares, many=True).data
 
 
 class RequisicaoUpdateStatusSerializer(serializers.Serializer):
@@ -0,0 +1,88 @@
+"""
+Detecção de requisições similares via MinHash + LSH (Locality Sensitive Hashing)
+Funções puras: o índice persistido fica em models.BucketSimilaridade
+
+O texto vira um conjunto de trigramas de caracteres (como no pg_trgm); a assinatura
+MinHash é dividida em bandas e cada banda gera um bucket. Requisições que
+compartilham ao menos um bucket são candidatas, confirmadas pelo Jaccard exato
+
+A assinatura usa "one permutation hashing" com densificação por rotação: cada
+trigrama é hasheado uma única vez (custo O(n) em vez de O(n * k) permutações)
+"""
+import hashlib
+import re
+import unicodedata
+
+NUM_BANDAS = 16
+LINHAS_POR_BANDA = 2
+NUM_HASHES = NUM_BANDAS * LINHAS_POR_BANDA
+MAX_CARACTERES = 2000  # Limita o custo da assinatura em descrições muito longas
+
+_NAO_ALFANUMERICO = re.compile(r'[^a-z0-9]+')
+
+
+def normalizar(texto):
+    """Minúsculas, sem acentos e apenas caracteres alfanuméricos separados por espaço"""
+    texto = unicodedata.normalize('NFKD', texto or '')
+    texto = ''.join(c for c in texto if not unicodedata.combining(c))
+    return _NAO_ALFANUMERICO.sub(' ', texto.lower()).strip()
+
+
+def normalizar_localizacao(localizacao):
+    return normalizar(localizacao)[:200]
+
+
+def trigramas(texto):
+    """Conjunto de trigramas por palavra, com as mesmas bordas do pg_trgm"""
+    conjunto = set()
+    for palavra in normalizar(texto[:MAX_CARACTERES]).split():
+        palavra = f'  {palavra} '
+        conjunto.update(palavra[i:i + 3] for i in range(len(palavra) - 2))
+    return conjunto
+
+
+def jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def _hash64(valor):
+    return int.from_bytes(hashlib.blake2b(valor, digest_size=8).digest(), 'big')
+
+
+def calcular_assinatura(conjunto):
+    """Assinatura MinHash com NUM_HASHES posições (vazia para conjunto vazio)"""
+    minimos = [None] * NUM_HASHES
+    for trigrama in conjunto:
+        valor = _hash64(trigrama.encode())
+        posicao, valor = valor % NUM_HASHES, valor // NUM_HASHES
+        if minimos[posicao] is None or valor < minimos[posicao]:
+            minimos[posicao] = valor
+    if all(minimo is None for minimo in minimos):
+        return []
+
+    # Densificação: posição vazia herda a próxima preenchida, deslocada pela distância
+    assinatura = []
+    for posicao in range(NUM_HASHES):
+        distancia = 0
+        while minimos[(posicao + distancia) % NUM_HASHES] is None:
+            distancia += 1
+        assinatura.append(minimos[(posicao + distancia) % NUM_HASHES] + (distancia << 64))
+    return assinatura
+
+
+def calcular_buckets(conjunto):
+    """Agrupa a assinatura em bandas; retorna um bucket (int64) por banda"""
+    assinatura = calcular_assinatura(conjunto)
+    if not assinatura:
+        return []
+    buckets = []
+    for banda in range(NUM_BANDAS):
+        linhas = assinatura[banda * LINHAS_POR_BANDA:(banda + 1) * LINHAS_POR_BANDA]
+        chave = f'{banda}:' + ','.join(map(str, linhas))
+        # Inteiro com sinal para caber em BigIntegerField
+        buckets.append(int.from_bytes(
+            hashlib.blake2b(chave.encode(), digest_size=8).digest(), 'big', signed=True
+        ))
+    return buckets
@@ -0,0 +1,107 @@
+"""
+Tarefas assíncronas (Celery) para processamento de anexos
+Nenhuma requisição HTTP espera por estas tarefas: são agendadas após o commit
+"""
+import io
+import logging
+from datetime import timedelta
+
+from celery import shared_task
+from django.core.files.base import ContentFile
+from django.utils import timezone
+from PIL import Image, ImageOps, UnidentifiedImageError
+
+from .models import Anexo
+
+logger = logging.getLogger(__name__)
+
+TAMANHO_THUMBNAIL = (320, 320)
+TAMANHO_PREVIEW = (1280, 1280)
+QUALIDADE_JPEG = 85
+# Imagem ainda não processada após este intervalo: tarefa perdida (broker fora, worker reiniciado)
+PROCESSAMENTO_ATRASADO_APOS = timedelta(minutes=10)
+
+
+def agendar_processamento_anexo(anexo_id):
+    """Enfileira o processamento; falha do broker não deve afetar a requisição"""
+    try:
+        processar_anexo.delay(anexo_id)
+    except Exception:
+        logger.exception('Não foi possível agendar o processamento do anexo %s', anexo_id)
+
+
+def anexos_pendentes_atrasados(intervalo=PROCESSAMENTO_ATRASADO_APOS):
+    """Anexos cujo processamento deveria ter terminado e precisam ser reagendados"""
+    return Anexo.objects.filter(processado_em__isnull=True, criado_em__lt=timezone.now() - intervalo)
+
+
+def _gerar_variante(imagem, tamanho=None):
+    """Redimensiona (se `tamanho`) e grava como JPEG progressivo, sem metadados EXIF"""
+    variante = imagem.copy()
+    if tamanho:
+        variante.thumbnail(tamanho, Image.LANCZOS)
+    if variante.mode in ('RGBA', 'LA', 'P'):
+        variante = variante.convert('RGBA')
+        fundo = Image.new('RGB', variante.size, (255, 255, 255))
+        fundo.paste(variante, mask=variante.getchannel('A'))
+        variante = fundo
+    elif variante.mode != 'RGB':
+        variante = variante.convert('RGB')
+
+    buffer = io.BytesIO()
+    variante.save(buffer, format='JPEG', quality=QUALIDADE_JPEG, optimize=True, progressive=True)
+    return ContentFile(buffer.getvalue())
+
+
+def _remover_variantes(storage, campos):
+    """Remove derivados já gravados quando o processamento não é concluído"""
+    for variante in Anexo.VARIANTES:
+        if campos.get(variante):
+            storage.delete(campos[variante])
+
+
+@shared_task(
+    ignore_result=True,
+    autoretry_for=(OSError,),
+    retry_backoff=True,
+    retry_backoff_max=600,
+    max_retries=5,
+)
+def processar_anexo(anexo_id):
+    """
+    Gera as variantes de anexos de imagem e registra as dimensões:
+    - web: resolução original, orientação aplicada e sem EXIF (servida por padrão)
+    - thumbnail/preview: versões reduzidas para listagens e visualização
+    O Anexo é deduplicado por conteúdo, então cada imagem é processada uma única vez
+    Falhas de E/S (storage indisponível) são repetidas com backoff exponencial;
+    esgotadas as tentativas, o comando reprocessar_anexos reagenda o anexo
+    """
+    anexo = Anexo.objects.filter(pk=anexo_id, processado_em__isnull=True).first()
+    if anexo is None:
+        return
+
+    storage = anexo.arquivo.storage
+    campos = {}
+    try:
+        with anexo.arquivo.open('rb') as arquivo, Image.open(arquivo) as imagem:
+            # Aplica a orientação do EXIF antes de descartá-lo
+            imagem = ImageOps.exif_transpose(imagem)
+            campos['largura'], campos['altura'] = imagem.size
+            base = f'anexos/derivados/{anexo.hash[:2]}/{anexo.hash}'
+            for variante, tamanho in (('web', None), ('thumbnail', TAMANHO_THUMBNAIL), ('preview', TAMANHO_PREVIEW)):
+                campos[variante] = storage.save(f'{base}_{variante}.jpg', _gerar_variante(imagem, tamanho))
+    except (UnidentifiedImageError, Image.DecompressionBombError):
+        # Não é imagem (PDF, etc.) ou é grande demais: apenas marca como processado
+        _remover_variantes(storage, campos)
+        campos = {}
+    except OSError:
+        logger.warning('Falha ao processar o anexo %s; nova tentativa agendada', anexo_id, exc_info=True)
+        _remover_variantes(storage, campos)
+        raise
+
+    # update() em vez de save(): o Anexo pode ter sido excluído durante o processamento
+    atualizados = Anexo.objects.filter(pk=anexo_id, processado_em__isnull=True).update(
+        processado_em=timezone.now(), **campos
+    )
+    if not atualizados:
+        _remover_variantes(storage, campos)
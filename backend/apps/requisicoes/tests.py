@@ -2,11 +2,20 @@
 Testes unitários para models e API
 Cobertura >80% seguindo TDD
 """
+import hashlib
+import io
+import os
+from datetime import timedelta
+
 import pytest
+from PIL import Image
 from django.contrib.auth.models import User
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.utils import timezone
 from rest_framework.test import APIClient
 from apps.usuarios.models import PerfilUsuario
-from apps.requisicoes.models import Requisicao
+from apps.requisicoes.models import Anexo, BucketSimilaridade, Requisicao
 
 @pytest.fixture
 def api_client():
@@ -18,6 +27,12 @@ def solicitante_user(db):
     PerfilUsuario.objects.create(user=user, role='solicitante')
     return user
 
+@pytest.fixture
+def outro_solicitante_user(db):
+    user = User.objects.create_user(username='outro', password='test123', email='outro@test.com')
+    PerfilUsuario.objects.create(user=user, role='solicitante')
+    return user
+
 @pytest.fixture
 def aprovador_user(db):
     user = User.objects.create_user(username='aprovador', password='test123', email='apr@test.com')
@@ -30,6 +45,20 @@ def executor_user(db):
     PerfilUsuario.objects.create(user=user, role='executor')
     return user
 
+@pytest.fixture
+def media_tmp(settings, tmp_path):
+    settings.MEDIA_ROOT = tmp_path
+    return tmp_path
+
+@pytest.fixture
+def celery_eager(settings):
+    # O Celery lê CELERY_* direto do settings do Django (namespace='CELERY')
+    settings.CELERY_TASK_ALWAYS_EAGER = True
+    settings.CELERY_TASK_EAGER_PROPAGATES = True
+    from config.celery import app
+    assert app.conf.task_always_eager
+    return app
+
 @pytest.mark.django_db
 class TestRequisicaoModel:
     def test_criar_requisicao_valida(self, solicitante_user):
@@ -95,4 +124,377 @@ class TestRequisicaoAPI:
             'status': 'concluido',
         })
 
-        assert response.status_code == 403, "Executor não deveria poder concluir uma requisição pendente"
\ No newline at end of file
+        assert response.status_code == 403, "Executor não deveria poder concluir uma requisição pendente"
+
+
+@pytest.mark.django_db
+class TestAnexoDeduplicado:
+    CONTEUDO = b'manual do equipamento ' * 100
+
+    def _criar(self, api_client, **extra):
+        dados = {
+            'titulo': 'Requisição com anexo',
+            'descricao': 'Descrição detalhada do problema',
+            'prioridade': 'media',
+        }
+        dados.update(extra)
+        return api_client.post('/api/requisicoes/', dados)
+
+    def test_upload_repetido_grava_arquivo_uma_vez(self, api_client, solicitante_user, media_tmp):
+        api_client.force_authenticate(user=solicitante_user)
+        for _ in range(2):
+            response = self._criar(api_client, anexo=SimpleUploadedFile('manual.pdf', self.CONTEUDO))
+            assert response.status_code == 201
+
+        anexo = Anexo.objects.get()
+        assert anexo.hash == hashlib.sha256(self.CONTEUDO).hexdigest()
+        assert anexo.referencias == 2
+        assert len([p for p in media_tmp.rglob('*') if p.is_file()]) == 1
+
+    def test_anexo_por_hash_dispensa_reenvio(self, api_client, solicitante_user, media_tmp):
+        api_client.force_authenticate(user=solicitante_user)
+        self._criar(api_client, anexo=SimpleUploadedFile('manual.pdf', self.CONTEUDO))
+        hash_conteudo = hashlib.sha256(self.CONTEUDO).hexdigest()
+
+        assert api_client.get(f'/api/anexos/{hash_conteudo}/').status_code == 200
+        response = self._criar(api_client, anexo_hash=hash_conteudo)
+        assert response.status_code == 201
+        assert Anexo.objects.get().referencias == 2
+
+        response = self._criar(api_client, anexo_hash='0' * 64)
+        assert response.status_code == 400
+
+    def test_excluir_ultima_referencia_remove_anexo(self, api_client, solicitante_user, media_tmp, django_capture_on_commit_callbacks):
+        api_client.force_authenticate(user=solicitante_user)
+        self._criar(api_client, anexo=SimpleUploadedFile('manual.pdf', self.CONTEUDO))
+        requisicao = Requisicao.objects.get()
+
+        with django_capture_on_commit_callbacks(execute=True):
+            requisicao.delete()
+
+        assert not Anexo.objects.exists()
+        assert not [p for p in media_tmp.rglob('*') if p.is_file()]
+
+    def test_excluir_uma_de_duas_referencias_mantem_anexo(self, api_client, solicitante_user, media_tmp, django_capture_on_commit_callbacks):
+        api_client.force_authenticate(user=solicitante_user)
+        for _ in range(2):
+            self._criar(api_client, anexo=SimpleUploadedFile('manual.pdf', self.CONTEUDO))
+        primeira, segunda = Requisicao.objects.order_by('id')
+
+        with django_capture_on_commit_callbacks(execute=True):
+            response = api_client.delete(f'/api/requisicoes/{primeira.id}/')
+        assert response.status_code == 204
+
+        anexo = Anexo.objects.get()
+        assert anexo.referencias == 1
+        assert anexo.arquivo.storage.exists(anexo.arquivo.name)
+        segunda.refresh_from_db()
+        assert segunda.anexo_armazenado_id == anexo.id
+
+    def test_anexo_excluido_concorrentemente_e_restaurado(self, solicitante_user, media_tmp, django_capture_on_commit_callbacks):
+        from apps.requisicoes.anexos import armazenar_anexo
+
+        anexo = armazenar_anexo(SimpleUploadedFile('manual.pdf', self.CONTEUDO))
+        # Simula o decrementar da última referência concluído antes do incremento
+        with django_capture_on_commit_callbacks(execute=True):
+            Anexo.objects.filter(pk=anexo.pk).update(referencias=1)
+            Anexo.decrementar(anexo.pk)
+        assert not Anexo.objects.exists()
+
+        requisicao = Requisicao.objects.create(
+            solicitante=solicitante_user,
+            titulo='Requisição com anexo',
+            descricao='Descrição detalhada do problema',
+            anexo_armazenado=anexo,
+        )
+        restaurado = Anexo.objects.get()
+        assert restaurado.pk == requisicao.anexo_armazenado_id
+        assert restaurado.referencias == 1
+        with restaurado.arquivo.open('rb') as arquivo:
+            assert arquivo.read() == self.CONTEUDO
+
+    def test_migrar_anexos_legados(self, solicitante_user, media_tmp, django_capture_on_commit_callbacks):
+        requisicoes = [
+            Requisicao.objects.create(
+                solicitante=solicitante_user,
+                titulo=f'Requisição legada {i}',
+                descricao='Descrição detalhada do problema',
+                anexo=SimpleUploadedFile('manual.pdf', self.CONTEUDO),
+            )
+            for i in range(2)
+        ]
+        legados = [r.anexo.path for r in requisicoes]
+
+        with django_capture_on_commit_callbacks(execute=True):
+            call_command('migrar_anexos_legados', '--remover-originais')
+
+        anexo = Anexo.objects.get()
+        assert anexo.referencias == 2
+        for requisicao in requisicoes:
+            requisicao.refresh_from_db()
+            assert requisicao.anexo_armazenado_id == anexo.id
+            assert not requisicao.anexo
+        assert not any(os.path.exists(caminho) for caminho in legados)
+        with anexo.arquivo.open('rb') as arquivo:
+            assert arquivo.read() == self.CONTEUDO
+
+    def test_download_parcial_com_range(self, api_client, solicitante_user, media_tmp):
+        api_client.force_authenticate(user=solicitante_user)
+        self._criar(api_client, anexo=SimpleUploadedFile('manual.pdf', self.CONTEUDO))
+        hash_conteudo = hashlib.sha256(self.CONTEUDO).hexdigest()
+        url = f'/api/anexos/{hash_conteudo}/download/'
+
+        response = api_client.get(url, HTTP_RANGE='bytes=10-19')
+        assert response.status_code == 206
+        assert b''.join(response.streaming_content) == self.CONTEUDO[10:20]
+        assert response['Content-Range'] == f'bytes 10-19/{len(self.CONTEUDO)}'
+
+        response = api_client.get(url, HTTP_RANGE=f'bytes={len(self.CONTEUDO)}-')
+        assert response.status_code == 416
+
+    def test_solicitante_nao_baixa_anexo_alheio(self, api_client, solicitante_user, outro_solicitante_user, media_tmp):
+        api_client.force_authenticate(user=solicitante_user)
+        self._criar(api_client, anexo=SimpleUploadedFile('manual.pdf', self.CONTEUDO))
+        hash_conteudo = hashlib.sha256(self.CONTEUDO).hexdigest()
+
+        api_client.force_authenticate(user=outro_solicitante_user)
+        assert api_client.get(f'/api/anexos/{hash_conteudo}/download/').status_code == 404
+
+    def test_solicitante_nao_usa_hash_de_anexo_alheio(self, api_client, solicitante_user, outro_solicitante_user, media_tmp):
+        api_client.force_authenticate(user=solicitante_user)
+        self._criar(api_client, anexo=SimpleUploadedFile('manual.pdf', self.CONTEUDO))
+        hash_conteudo = hashlib.sha256(self.CONTEUDO).hexdigest()
+
+        api_client.force_authenticate(user=outro_solicitante_user)
+        assert api_client.get(f'/api/anexos/{hash_conteudo}/').status_code == 404
+        response = self._criar(api_client, anexo_hash=hash_conteudo)
+        assert response.status_code == 400
+        assert 'anexo_hash' in response.data
+        assert Anexo.objects.get().referencias == 1
+
+
+@pytest.mark.django_db
+class TestProcessamentoAnexo:
+    def _imagem_com_exif(self, tamanho=(2000, 1000)):
+        exif = Image.Exif()
+        exif[0x010F] = 'Fabricante da câmera'
+        buffer = io.BytesIO()
+        Image.new('RGB', tamanho, (200, 30, 30)).save(buffer, format='JPEG', exif=exif)
+        return SimpleUploadedFile('foto.jpg', buffer.getvalue(), content_type='image/jpeg')
+
+    def test_gera_thumbnail_e_preview_apos_commit(self, api_client, solicitante_user, media_tmp, celery_eager, django_capture_on_commit_callbacks):
+        api_client.force_authenticate(user=solicitante_user)
+        with django_capture_on_commit_callbacks(execute=True) as callbacks:
+            response = api_client.post('/api/requisicoes/', {
+                'titulo': 'Máquina parada',
+                'descricao': 'Foto do painel com defeito',
+                'prioridade': 'alta',
+                'anexo': self._imagem_com_exif(),
+            })
+        assert response.status_code == 201
+        assert len(callbacks) == 1
+
+        anexo = Anexo.objects.get()
+        assert (anexo.largura, anexo.altura) == (2000, 1000)
+        assert anexo.processado_em is not None
+        with anexo.thumbnail.open('rb') as arquivo, Image.open(arquivo) as thumb:
+            assert max(thumb.size) <= 320
+            assert not thumb.getexif()
+
+        detalhe = api_client.get(f'/api/requisicoes/{Requisicao.objects.get().id}/').data
+        assert detalhe['anexo_detalhes']['largura'] == 2000
+        assert detalhe['anexo_detalhes']['thumbnail'].endswith('?variante=thumbnail')
+
+        # Download padrão entrega a variante web: mesma resolução, sem EXIF
+        response = api_client.get(detalhe['anexo'], HTTP_ACCEPT='text/html')
+        assert response.status_code == 200
+        assert 'filename="foto.jpg"' in response['Content-Disposition']
+        with Image.open(io.BytesIO(b''.join(response.streaming_content))) as web:
+            assert web.size == (2000, 1000)
+            assert not web.getexif()
+
+    def test_imagem_nao_e_servida_antes_do_processamento(self, api_client, solicitante_user, media_tmp, celery_eager, django_capture_on_commit_callbacks):
+        api_client.force_authenticate(user=solicitante_user)
+        with django_capture_on_commit_callbacks(execute=False):
+            response = api_client.post('/api/requisicoes/', {
+                'titulo': 'Máquina parada',
+                'descricao': 'Foto do painel com defeito',
+                'prioridade': 'alta',
+                'anexo': self._imagem_com_exif(),
+            })
+        response = api_client.get(response.data['anexo'], HTTP_ACCEPT='image/avif,image/webp,*/*')
+        assert response.status_code == 503
+        assert response['Retry-After']
+        assert response['Content-Type'] == 'application/json'
+
+    def test_download_reagenda_processamento_atrasado(self, api_client, solicitante_user, media_tmp, celery_eager, django_capture_on_commit_callbacks):
+        api_client.force_authenticate(user=solicitante_user)
+        with django_capture_on_commit_callbacks(execute=False):
+            response = api_client.post('/api/requisicoes/', {
+                'titulo': 'Máquina parada',
+                'descricao': 'Foto do painel com defeito',
+                'prioridade': 'alta',
+                'anexo': self._imagem_com_exif((400, 200)),
+            })
+        url = response.data['anexo']
+        # Tarefa perdida: anexo pendente há mais tempo que o esperado
+        Anexo.objects.update(criado_em=timezone.now() - timedelta(hours=1))
+
+        assert api_client.get(url).status_code == 503
+        assert Anexo.objects.get().processado_em is not None
+        assert api_client.get(url).status_code == 200
+
+    def test_comando_reprocessa_anexos_atrasados(self, solicitante_user, media_tmp, celery_eager):
+        from apps.requisicoes.anexos import armazenar_anexo
+
+        atrasado = armazenar_anexo(self._imagem_com_exif((400, 200)))
+        recente = armazenar_anexo(self._imagem_com_exif((300, 200)))
+        Anexo.objects.filter(pk=atrasado.pk).update(criado_em=timezone.now() - timedelta(hours=1))
+
+        call_command('reprocessar_anexos', stdout=io.StringIO())
+
+        atrasado.refresh_from_db()
+        recente.refresh_from_db()
+        assert atrasado.processado_em is not None
+        assert recente.processado_em is None
+
+    def test_falha_de_io_e_repetida(self, solicitante_user, media_tmp, celery_eager, settings, monkeypatch):
+        from apps.requisicoes import tasks
+        from apps.requisicoes.anexos import armazenar_anexo
+
+        anexo = armazenar_anexo(self._imagem_com_exif((400, 200)))
+        gerar_variante = tasks._gerar_variante
+        falhas = []
+
+        def gerar_com_falha(imagem, tamanho=None):
+            if not falhas:
+                falhas.append(tamanho)
+                raise OSError('storage indisponível')
+            return gerar_variante(imagem, tamanho)
+
+        monkeypatch.setattr(tasks, '_gerar_variante', gerar_com_falha)
+        # Sem propagar exceções, o modo eager executa a nova tentativa na hora
+        settings.CELERY_TASK_EAGER_PROPAGATES = False
+        tasks.processar_anexo.delay(anexo.id)
+
+        anexo.refresh_from_db()
+        assert falhas
+        assert anexo.processado_em is not None
+
+    def test_anexo_excluido_durante_processamento_remove_derivados(self, solicitante_user, media_tmp, celery_eager, monkeypatch):
+        from apps.requisicoes import tasks
+        from apps.requisicoes.anexos import armazenar_anexo
+
+        anexo = armazenar_anexo(self._imagem_com_exif((400, 200)))
+        gerar_variante = tasks._gerar_variante
+
+        def gerar_e_excluir(imagem, tamanho=None):
+            Anexo.objects.filter(pk=anexo.pk).delete()
+            return gerar_variante(imagem, tamanho)
+
+        monkeypatch.setattr(tasks, '_gerar_variante', gerar_e_excluir)
+        tasks.processar_anexo.delay(anexo.id)
+
+        assert not Anexo.objects.exists()
+        assert not list((media_tmp / 'anexos' / 'derivados').rglob('*.jpg'))
+
+    def test_processamento_agendado_somente_apos_commit(self, api_client, solicitante_user, media_tmp, celery_eager, django_capture_on_commit_callbacks):
+        api_client.force_authenticate(user=solicitante_user)
+        with django_capture_on_commit_callbacks(execute=False):
+            api_client.post('/api/requisicoes/', {
+                'titulo': 'Máquina parada',
+                'descricao': 'Foto do painel com defeito',
+                'prioridade': 'alta',
+                'anexo': self._imagem_com_exif(),
+            })
+        assert Anexo.objects.get().processado_em is None
+
+    def test_anexo_que_nao_e_imagem_apenas_marca_processado(self, solicitante_user, media_tmp, celery_eager):
+        from apps.requisicoes.anexos import armazenar_anexo
+        from apps.requisicoes.tasks import processar_anexo
+
+        anexo = armazenar_anexo(SimpleUploadedFile('manual.pdf', b'%PDF-1.4 conteudo'))
+        processar_anexo.delay(anexo.id)
+        anexo.refresh_from_db()
+        assert anexo.processado_em is not None
+        assert anexo.largura is None
+        assert not anexo.thumbnail
+
+
+@pytest.mark.django_db
+class TestRequisicoesSimilares:
+    DADOS = {
+        'titulo': 'Prensa 3 parada',
+        'descricao': 'Motor da prensa hidráulica parou de funcionar durante o turno',
+        'prioridade': 'alta',
+        'localizacao': 'Galpão B - Linha 2',
+    }
+
+    def _criar(self, solicitante, **extra):
+        dados = dict(self.DADOS)
+        dados.update(extra)
+        return Requisicao.objects.create(solicitante=solicitante, **dados)
+
+    def test_indice_acompanha_status(self, solicitante_user):
+        req = self._criar(solicitante_user)
+        assert BucketSimilaridade.objects.filter(requisicao=req).exists()
+
+        req.status = 'concluido'
+        req.save()
+        assert not BucketSimilaridade.objects.filter(requisicao=req).exists()
+
+    def test_busca_similar_no_mesmo_local(self, solicitante_user):
+        original = self._criar(solicitante_user)
+        self._criar(solicitante_user, localizacao='Almoxarifado')
+        self._criar(solicitante_user, titulo='Lâmpada queimada', descricao='Trocar lâmpada do corredor principal')
+
+        similares = BucketSimilaridade.buscar_similares(
+            'Prensa 3 não liga', 'O motor da prensa hidraulica parou no turno da manhã', 'galpao b - linha 2'
+        )
+        assert [r.id for r in similares] == [original.id]
+
+    def test_corte_de_candidatos_prioriza_mais_bandas(self, solicitante_user, monkeypatch):
+        monkeypatch.setattr(BucketSimilaridade, 'MAX_CANDIDATOS', 1)
+        original = self._criar(solicitante_user)
+        # Candidatos fracos (poucas bandas em comum) criados depois, com ids maiores
+        for i in range(3):
+            self._criar(solicitante_user, titulo=f'Prensa {i} com ruído', descricao=f'Ruído no rolamento da esteira {i} do turno')
+
+        similares = BucketSimilaridade.buscar_similares(
+            self.DADOS['titulo'], self.DADOS['descricao'], self.DADOS['localizacao']
+        )
+        assert [r.id for r in similares] == [original.id]
+
+    def test_criacao_avisa_duplicata_sem_bloquear(self, api_client, solicitante_user):
+        existente = self._criar(solicitante_user)
+        api_client.force_authenticate(user=solicitante_user)
+
+        response = api_client.post('/api/requisicoes/', self.DADOS)
+        assert response.status_code == 201
+        similar = response.json()['similares'][0]
+        assert similar['id'] == existente.id
+        assert isinstance(similar['similaridade'], float)
+        assert Requisicao.objects.count() == 2
+
+    def test_similares_respeitam_visibilidade(self, api_client, solicitante_user, outro_solicitante_user, aprovador_user):
+        alheia = self._criar(outro_solicitante_user)
+
+        api_client.force_authenticate(user=solicitante_user)
+        response = api_client.post('/api/requisicoes/', self.DADOS)
+        assert response.status_code == 201
+        assert response.json()['similares'] == []
+        propria = Requisicao.objects.get(solicitante=solicitante_user)
+        assert api_client.get(f'/api/requisicoes/{propria.id}/similares/').data == []
+
+        api_client.force_authenticate(user=aprovador_user)
+        response = api_client.get(f'/api/requisicoes/{propria.id}/similares/')
+        assert [r['id'] for r in response.data] == [alheia.id]
+
+    def test_action_similares(self, api_client, solicitante_user, aprovador_user):
+        primeira = self._criar(solicitante_user)
+        segunda = self._criar(solicitante_user, titulo='Prensa 3 travada')
+
+        api_client.force_authenticate(user=aprovador_user)
+        response = api_client.get(f'/api/requisicoes/{segunda.id}/similares/')
+        assert response.status_code == 200
+        assert [r['id'] for r in response.data] == [primeira.id]
@@ -3,10 +3,11 @@ URLs do app de requisições
 """
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from .views import RequisicaoViewSet
+from .views import AnexoViewSet, RequisicaoViewSet
 
 router = DefaultRouter()
 router.register(r'requisicoes', RequisicaoViewSet, basename='requisicao')
+router.register(r'anexos', AnexoViewSet, basename='anexo')
 
 urlpatterns = [
     path('', include(router.urls)),
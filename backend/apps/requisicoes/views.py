@@ -6,16 +6,21 @@ from rest_framework import viewsets, status, filters
 from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated
+from django.db import transaction
 from django.utils import timezone
 from django_filters.rest_framework import DjangoFilterBackend
 
-from .models import Requisicao, HistoricoRequisicao
+from .anexos import HASH_REGEX, servir_anexo
+from .models import Anexo, BucketSimilaridade, Requisicao, HistoricoRequisicao
 from .serializers import (
+    AnexoSerializer,
     RequisicaoSerializer, 
+    RequisicaoSimilarSerializer,
     RequisicaoCreateSerializer,
     RequisicaoUpdateStatusSerializer
 )
 from .permissions import CanUpdateStatus
+from .tasks import PROCESSAMENTO_ATRASADO_APOS, agendar_processamento_anexo
 
 class RequisicaoViewSet(viewsets.ModelViewSet):
     """
@@ -28,6 +33,7 @@ class RequisicaoViewSet(viewsets.ModelViewSet):
     - PUT/PATCH /api/requisicoes/{id}/ - Atualiza requisição
     - DELETE /api/requisicoes/{id}/ - Deleta requisição
     - POST /api/requisicoes/{id}/atualizar_status/ - Atualiza status
+    - GET /api/requisicoes/{id}/similares/ - Requisições abertas similares no mesmo local
     """
     permission_classes = [IsAuthenticated]
     filter_backends = [DjangoFilterBackend, filters.SearchFilter, filters.OrderingFilter]
@@ -42,16 +48,7 @@ class RequisicaoViewSet(viewsets.ModelViewSet):
         - Solicitante: vê apenas suas próprias requisições
         - Aprovador/Executor: vê todas as requisições
         """
-        user = self.request.user
-        
-        if not hasattr(user, 'perfil'):
-            return Requisicao.objects.none()
-        
-        if user.perfil.role == 'solicitante':
-            return Requisicao.objects.filter(solicitante=user)
-        
-        # Aprovadores e executores veem todas
-        return Requisicao.objects.all()
+        return Requisicao.visiveis_para(self.request.user).select_related('anexo_armazenado')
     
     def get_serializer_class(self):
         """Usa serializer apropriado baseado na ação"""
@@ -61,7 +58,18 @@ class RequisicaoViewSet(viewsets.ModelViewSet):
     
     def perform_create(self, serializer):
         """Adiciona solicitante automaticamente na criação"""
-        serializer.save(solicitante=self.request.user)
+        requisicao = serializer.save(solicitante=self.request.user)
+        self._agendar_processamento_anexo(requisicao)
+    
+    def perform_update(self, serializer):
+        requisicao = serializer.save()
+        self._agendar_processamento_anexo(requisicao)
+    
+    def _agendar_processamento_anexo(self, requisicao):
+        """Thumbnails/preview são gerados pelo Celery somente após o commit"""
+        if requisicao.anexo_armazenado_id and requisicao.anexo_armazenado.processado_em is None:
+            anexo_id = requisicao.anexo_armazenado_id
+            transaction.on_commit(lambda: agendar_processamento_anexo(anexo_id))
     
     @action(detail=True, methods=['post'], permission_classes=[IsAuthenticated, CanUpdateStatus])
     def atualizar_status(self, request, pk=None):
@@ -135,6 +143,19 @@ class RequisicaoViewSet(viewsets.ModelViewSet):
         
         return False
     
+    @action(detail=True, methods=['get'])
+    def similares(self, request, pk=None):
+        """
+        Lista requisições abertas similares (possíveis duplicatas) no mesmo local
+        Solicitantes só recebem as próprias requisições
+        """
+        requisicao = self.get_object()
+        similares = BucketSimilaridade.buscar_similares(
+            requisicao.titulo, requisicao.descricao, requisicao.localizacao,
+            excluir_id=requisicao.pk, usuario=request.user
+        )
+        return Response(RequisicaoSimilarSerializer(similares, many=True).data)
+    
     @action(detail=False, methods=['get'])
     def minhas_requisicoes(self, request):
         """Endpoint para listar apenas requisições do usuário logado"""
@@ -159,4 +180,67 @@ class RequisicaoViewSet(viewsets.ModelViewSet):
             return self.get_paginated_response(serializer.data)
         
         serializer = self.get_serializer(requisicoes, many=True)
-        return Response(serializer.data)
\ No newline at end of file
+        return Response(serializer.data)
+
+
+class AnexoViewSet(viewsets.GenericViewSet):
+    """
+    Anexos deduplicados por conteúdo (SHA-256)
+    
+    Endpoints:
+    - GET /api/anexos/{hash}/ - Metadados; 404 indica que o arquivo precisa ser enviado
+    - GET /api/anexos/{hash}/download/ - Conteúdo do arquivo (suporta Range e ETag);
+      imagens são entregues já sem EXIF (variante web)
+    - GET /api/anexos/{hash}/download/?variante=web|thumbnail|preview - Variante da imagem
+    
+    Solicitantes só enxergam anexos das próprias requisições (ver Anexo.visiveis_para)
+    """
+    permission_classes = [IsAuthenticated]
+    serializer_class = AnexoSerializer
+    lookup_field = 'hash'
+    lookup_value_regex = HASH_REGEX
+    
+    def get_queryset(self):
+        return Anexo.visiveis_para(self.request.user)
+    
+    def perform_content_negotiation(self, request, force=False):
+        """
+        O download responde com o próprio arquivo, então qualquer Accept é aceito;
+        respostas de erro caem no JSONRenderer (application/json)
+        """
+        return super().perform_content_negotiation(request, force=True)
+    
+    def retrieve(self, request, hash=None):
+        """Permite ao cliente verificar se pode usar anexo_hash em vez de enviar o arquivo"""
+        anexo = self.get_object()
+        return Response(self.get_serializer(anexo).data)
+    
+    @action(detail=True, methods=['get'])
+    def download(self, request, hash=None):
+        """
+        Entrega o arquivo ou uma de suas variantes
+        Para imagens, o padrão é a variante web (sem EXIF); o original nunca é servido
+        Enquanto a imagem não é processada responde 503 com Retry-After; se o
+        processamento estiver atrasado (tarefa perdida), ele é reagendado
+        """
+        variante = request.query_params.get('variante')
+        if variante and variante not in Anexo.VARIANTES:
+            return Response(
+                {'erro': f"Variante inválida. Opções: {', '.join(Anexo.VARIANTES)}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        
+        anexo = self.get_object()
+        if anexo.imagem_pendente:
+            if anexo.criado_em < timezone.now() - PROCESSAMENTO_ATRASADO_APOS:
+                agendar_processamento_anexo(anexo.id)
+            return Response(
+                {'erro': 'Imagem em processamento'},
+                status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                headers={'Retry-After': '5'}
+            )
+        if not variante and anexo.web:
+            variante = 'web'
+        if variante and not getattr(anexo, variante):
+            return Response({'erro': 'Variante não disponível'}, status=status.HTTP_404_NOT_FOUND)
+        return servir_anexo(request, anexo, variante)
@@ -0,0 +1,13 @@
+"""
+Aplicação Celery do projeto
+Lê as configurações CELERY_* de settings.py e descobre tasks.py dos apps
+"""
+import os
+
+from celery import Celery
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'config.settings')
+
+app = Celery('config')
+app.config_from_object('django.conf:settings', namespace='CELERY')
+app.autodiscover_tasks()
@@ -97,6 +97,11 @@ STATIC_ROOT = BASE_DIR / 'staticfiles'
 MEDIA_URL = 'media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Entrega de anexos delegada ao servidor web (ex.: 'X-Accel-Redirect' no nginx)
+# Vazio = Django serve o arquivo diretamente
+ANEXOS_SENDFILE_HEADER = config('ANEXOS_SENDFILE_HEADER', default='')
+ANEXOS_SENDFILE_PREFIX = config('ANEXOS_SENDFILE_PREFIX', default='/protected-media/')
+
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
 # REST Framework Configuration
@@ -137,6 +142,24 @@ SPECTACULAR_SETTINGS = {
     'VERSION': '1.0.0',
 }
 
-# Celery Configuration (para tarefas assíncronas futuras)
+# Detecção de requisições similares (Jaccard mínimo entre trigramas de título + descrição)
+SIMILARIDADE_LIMIAR = config('SIMILARIDADE_LIMIAR', default=0.35, cast=float)
+
+# Celery Configuration (processamento de anexos em background)
 CELERY_BROKER_URL = config('CELERY_BROKER_URL', default='redis://localhost:6379/0')
-CELERY_RESULT_BACKEND = config('CELERY_RESULT_BACKEND', default='redis://localhost:6379/0')
\ No newline at end of file
+CELERY_RESULT_BACKEND = config('CELERY_RESULT_BACKEND', default='redis://localhost:6379/0')
+# Modo eager executa as tasks no próprio processo (testes/dev sem broker)
+CELERY_TASK_ALWAYS_EAGER = config('CELERY_TASK_ALWAYS_EAGER', default=False, cast=bool)
+CELERY_TASK_EAGER_PROPAGATES = CELERY_TASK_ALWAYS_EAGER
+CELERY_TASK_ACKS_LATE = True
+CELERY_WORKER_PREFETCH_MULTIPLIER = 1
+# O agendamento roda em on_commit, dentro do ciclo da requisição HTTP:
+# broker inacessível deve falhar rápido (o comando reprocessar_anexos recupera depois)
+CELERY_BROKER_CONNECTION_TIMEOUT = 2
+CELERY_BROKER_TRANSPORT_OPTIONS = {'socket_connect_timeout': 2}
+CELERY_TASK_PUBLISH_RETRY_POLICY = {
+    'max_retries': 1,
+    'interval_start': 0,
+    'interval_step': 0.5,
+    'interval_max': 0.5,
+}
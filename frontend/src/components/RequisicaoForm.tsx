@@ -29,6 +29,9 @@ export default function RequisicaoForm({ onSuccess }: Props) {
     mutation.mutate(data);
   };
   
+  // Possíveis duplicatas retornadas pela API (apenas aviso, a requisição já foi criada)
+  const similares = mutation.data?.similares ?? [];
+  
   return (
     <form onSubmit={handleSubmit(onSubmit)} className="space-y-6 bg-white p-6 rounded-lg shadow">
       <h2 className="text-2xl font-bold text-gray-800">Nova Requisição de Manutenção</h2>
@@ -129,6 +132,19 @@ export default function RequisicaoForm({ onSuccess }: Props) {
           <p className="text-sm text-green-600">Requisição criada com sucesso!</p>
         </div>
       )}
+      
+      {mutation.isSuccess && similares.length > 0 && (
+        <div className="p-3 bg-yellow-50 border border-yellow-200 rounded-md">
+          <p className="text-sm text-yellow-700">
+            Já existem requisições abertas parecidas neste local:
+          </p>
+          <ul className="mt-1 list-disc list-inside text-sm text-yellow-700">
+            {similares.map((similar) => (
+              <li key={similar.id}>#{similar.id} - {similar.titulo}</li>
+            ))}
+          </ul>
+        </div>
+      )}
     </form>
   );
 }
\ No newline at end of file
@@ -21,6 +21,7 @@ export interface Requisicao {
   localizacao?: string;
   observacoes?: string;
   anexo?: string;
+  anexo_detalhes?: AnexoDetalhes | null;
   solicitante: number;
   solicitante_nome: string;
   aprovador?: number;
@@ -32,6 +33,29 @@ export interface Requisicao {
   data_aprovacao?: string;
   data_conclusao?: string;
   historico?: Historico[];
+  similares?: RequisicaoSimilar[];
+}
+
+export interface RequisicaoSimilar {
+  id: number;
+  titulo: string;
+  status: Requisicao['status'];
+  prioridade: Requisicao['prioridade'];
+  localizacao: string;
+  criado_em: string;
+  similaridade: number;
+}
+
+export interface AnexoDetalhes {
+  hash: string;
+  nome_original: string;
+  content_type: string;
+  tamanho: number;
+  largura?: number | null;
+  altura?: number | null;
+  thumbnail?: string | null;
+  preview?: string | null;
+  criado_em: string;
 }
 
 export interface Historico {